@@ -7,6 +7,13 @@ from utils.tal import TaskAlignedAssigner, dist2bbox, make_anchors
 from .distillation_loss import kd_loss, rkd_loss
 
 
+def _segment_slots(index, minlength):
+    """Returns per-segment counts and each element's slot in its (sorted) segment."""
+    counts = index.new_zeros(minlength).scatter_add_(0, index, torch.ones_like(index))
+    offsets = counts.cumsum(0) - counts
+    return counts, torch.arange(len(index), device=index.device) - offsets[index]
+
+
 class v8DetectionLoss:
     """Criterion class for computing training losses."""
 
@@ -19,11 +26,11 @@ class v8DetectionLoss:
         cls_gain=0.5,
         dfl_gain=1.5,
         embed_gain=1,
+        compile=False,
     ):  # model must be de-paralleled
         """Initializes v8DetectionLoss with the model, defining model-related properties and BCE loss function."""
 
         m = head  # Detect() module
-        self.bce = nn.BCEWithLogitsLoss(reduction="none")
         self.hyp = {
             "box": box_gain,
             "cls": cls_gain,
@@ -35,7 +42,7 @@ class v8DetectionLoss:
         self.no = m.nc + m.reg_max * 4
         self.embedding_size = m.embedding_size
         self.reg_max = m.reg_max
-        self.device = device
+        self.device = torch.device(device)
 
         self.use_dfl = m.reg_max > 1
 
@@ -44,39 +51,63 @@ class v8DetectionLoss:
         )
         self.bbox_loss = BboxLoss(m.reg_max).to(device)
         self.proj = torch.arange(m.reg_max, dtype=torch.float, device=device)
+        self._anchor_cache = {}
+        self._max_gt = 0  # padded number of targets per image, grown on demand
+        self._loss_buf = torch.zeros(4, device=self.device)
+        # target assignment has data-dependent shapes, so only the dense decode
+        # stage is compiled; new shapes recompile up to dynamo's cache limit
+        self._decode = (
+            torch.compile(self.decode_predictions, dynamic=False)
+            if compile
+            else self.decode_predictions
+        )
+
+    def _make_anchors(self, feats):
+        """Returns anchor points, stride tensor and image size, cached per shape."""
+        dtype = feats[0].dtype
+        key = (tuple(xi.shape[2:] for xi in feats), dtype, feats[0].device)
+        if key not in self._anchor_cache:
+            anchor_points, stride_tensor = make_anchors(feats, self.stride, 0.5)
+            imgsz = (
+                torch.tensor(feats[0].shape[2:], device=self.device, dtype=dtype)
+                * self.stride[0]
+            )  # image size (h,w)
+            self._anchor_cache[key] = anchor_points, stride_tensor, imgsz
+        return self._anchor_cache[key]
+
+    def _to_device(self, x):
+        """Copies a host tensor to the device without blocking, pinned on CUDA."""
+        if self.device.type == "cuda" and x.device.type == "cpu":
+            x = x.pin_memory()
+        return x.to(self.device, non_blocking=True)
 
-    def preprocess(self, targets, batch_size, scale_tensor):
+    def preprocess(self, targets, target_idx, batch_size, scale_tensor):
         """Preprocesses the target counts and matches with the input batch size to output a tensor."""
-        nl, ne = targets.shape
-        if nl == 0:
-            out = torch.zeros(batch_size, 0, ne - 1, device=self.device)
-        else:
-            i = targets[:, 0]  # image index
-            _, counts = i.unique(return_counts=True)
-            counts = counts.to(dtype=torch.int32)
-            out = torch.zeros(batch_size, counts.max(), ne - 1, device=self.device)
-            for j in range(batch_size):
-                matches = i == j
-                n = matches.sum()
-                if n:
-                    out[j, :n] = targets[matches, 1:]
+        out = self._scatter_targets(targets, target_idx, batch_size)
+        if out.shape[1]:
             out[..., 1:5] = xywh2xyxy(out[..., 1:5].mul_(scale_tensor))
         return out
 
-    def preprocess_embedding(self, targets, batch_size):
-        nl, ne = targets.shape
-        if nl == 0:
-            out = torch.zeros(batch_size, 0, ne - 1, device=self.device)
-        else:
-            i = targets[:, 0]
-            _, counts = i.unique(return_counts=True)
-            counts = counts.to(dtype=torch.int32)
-            out = torch.zeros(batch_size, counts.max(), ne - 1, device=self.device)
-            for j in range(batch_size):
-                matches = i == j
-                n = matches.sum()
-                if n:
-                    out[j, :n] = targets[matches, 1:]
+    def preprocess_embedding(self, targets, target_idx, batch_size):
+        return self._scatter_targets(targets, target_idx, batch_size)
+
+    def _target_slots(self, batch_idx, batch_size):
+        """Returns the (image, slot) index of every target row, (2, n), on the host."""
+        i = batch_idx.view(-1).long().cpu()  # image index, a host tensor in training
+        order = i.argsort(stable=True)
+        counts, sorted_slot = _segment_slots(i[order], batch_size)
+        # counting on the host keeps the padded bound free of device syncs
+        self._max_gt = max(self._max_gt, int(counts.max()))
+        slot = torch.empty_like(i)
+        slot[order] = sorted_slot
+        return torch.stack((i, slot))
+
+    def _scatter_targets(self, targets, target_idx, batch_size):
+        """Scatters target rows into a zero-padded (batch_size, max_gt, ...) tensor."""
+        out = torch.zeros(
+            batch_size, self._max_gt, targets.shape[1] - 1, device=self.device
+        )
+        out[target_idx[0], target_idx[1]] = targets[:, 1:].to(out.dtype)
         return out
 
     def bbox_decode(self, anchor_points, pred_dist):
@@ -92,57 +123,86 @@ class v8DetectionLoss:
             # pred_dist = (pred_dist.view(b, a, c // 4, 4).softmax(2) * self.proj.type(pred_dist.dtype).view(1, 1, -1, 1)).sum(2)
         return dist2bbox(pred_dist, anchor_points, xywh=False)
 
-    def __call__(self, preds, batch, embed_topk=3):
-        """Calculate the sum of the loss for box, cls and dfl multiplied by batch size."""
-        loss = torch.zeros(4, device=self.device)  # box, cls, dfl
-        pred_detect = preds[0]
-        pred_embeds = preds[1]
-        feats = pred_detect[1] if isinstance(pred_detect, tuple) else pred_detect
+    def select_embed_anchors(
+        self, scores, fg_idx, fg_gt_idx, fg_mask, n_max_boxes, topk
+    ):
+        """Selects the top-k foreground anchors by score for every gt, (b, h*w)."""
+        batch_idx, anchor_idx = fg_idx
+        # sort the foreground by score, then stably group it by (image, gt) so that each
+        # group stays score-ordered and an anchor's slot in its group is its rank
+        order = scores.argsort(descending=True, stable=True)
+        group, group_order = (batch_idx * n_max_boxes + fg_gt_idx)[order].sort(
+            stable=True
+        )
+        order = order[group_order]
+        _, rank = _segment_slots(group, fg_mask.shape[0] * n_max_boxes)
+        embed_mask = torch.zeros_like(fg_mask)
+        embed_mask[batch_idx[order], anchor_idx[order]] = rank < topk
+        return embed_mask
+
+    def decode_predictions(self, feats, pred_embeds, anchor_points):
+        """Reshapes the head outputs to (b, h*w, c) and decodes the predicted boxes."""
+        # concatenating (b, h*w, c) views along the anchors yields the final layout
         pred_distri, pred_scores = torch.cat(
-            [xi.view(feats[0].shape[0], self.no, -1) for xi in feats], 2
-        ).split((self.reg_max * 4, self.nc), 1)
-        pred_scores = pred_scores.permute(0, 2, 1).contiguous()
-        pred_distri = pred_distri.permute(0, 2, 1).contiguous()
+            [xi.view(feats[0].shape[0], self.no, -1).transpose(1, 2) for xi in feats], 1
+        ).split((self.reg_max * 4, self.nc), 2)
         # embeeding
         pred_embeds = torch.cat(
-            [xi.view(feats[0].shape[0], self.embedding_size, -1) for xi in pred_embeds],
-            dim=2,
+            [
+                xi.view(feats[0].shape[0], self.embedding_size, -1).transpose(1, 2)
+                for xi in pred_embeds
+            ],
+            dim=1,
         )
-        pred_embeds = pred_embeds.permute(0, 2, 1).contiguous()
-        l2_norm = pred_embeds.norm(2, dim=-1, keepdim=True)
-        pred_embeds = pred_embeds / l2_norm
 
+        # Pboxes
+        pred_bboxes = self.bbox_decode(anchor_points, pred_distri)  # xyxy, (b, h*w, 4)
+
+        # probabilities for the assigner, the cls loss keeps working on the logits
+        pred_probs = pred_scores.detach().sigmoid()
+        return pred_distri, pred_scores, pred_embeds, pred_bboxes, pred_probs
+
+    def __call__(self, preds, batch, embed_topk=3):
+        """Calculate the sum of the loss for box, cls and dfl multiplied by batch size."""
+        # reuse the scratch buffer, detached so no autograd history carries over
+        loss = self._loss_buf.detach().zero_()  # box, cls, dfl, embed
+        pred_detect = preds[0]
+        feats = pred_detect[1] if isinstance(pred_detect, tuple) else pred_detect
+        batch_size = feats[0].shape[0]
+        # issue the host->device target copies first so they overlap with the work below
+        target_idx = self._to_device(self._target_slots(batch["batch_idx"], batch_size))
+        targets = self._to_device(
+            torch.cat(
+                (
+                    batch["batch_idx"].view(-1, 1),
+                    batch["cls"].view(-1, 1),
+                    batch["bboxes"],
+                ),
+                1,
+            )
+        )
+        targets_embed = self._to_device(
+            torch.cat((batch["batch_idx"].view(-1, 1), batch["embedding"]), dim=1)
+        )
+        anchor_points, stride_tensor, imgsz = self._make_anchors(feats)
+        pred_distri, pred_scores, pred_embeds, pred_bboxes, pred_probs = self._decode(
+            feats, preds[1], anchor_points
+        )
         dtype = pred_scores.dtype
-        batch_size = pred_scores.shape[0]
-        imgsz = (
-            torch.tensor(feats[0].shape[2:], device=self.device, dtype=dtype)
-            * self.stride[0]
-        )  # image size (h,w)
-        anchor_points, stride_tensor = make_anchors(feats, self.stride, 0.5)
 
         # Targets
-        targets = torch.cat(
-            (batch["batch_idx"].view(-1, 1), batch["cls"].view(-1, 1), batch["bboxes"]),
-            1,
-        )
         targets = self.preprocess(
-            targets.to(self.device), batch_size, scale_tensor=imgsz[[1, 0, 1, 0]]
+            targets, target_idx, batch_size, scale_tensor=imgsz[[1, 0, 1, 0]]
         )
-        targets_embed = torch.cat(
-            (batch["batch_idx"].view(-1, 1), batch["embedding"]), dim=1
-        )
-        gt_embeds = self.preprocess_embedding(targets_embed.to(self.device), batch_size)
+        gt_embeds = self.preprocess_embedding(targets_embed, target_idx, batch_size)
         gt_labels, gt_bboxes = targets.split((1, 4), 2)  # cls, xyxy
         mask_gt = gt_bboxes.sum(2, keepdim=True).gt_(0.0)
 
         del targets, targets_embed
 
-        # Pboxes
-        pred_bboxes = self.bbox_decode(anchor_points, pred_distri)  # xyxy, (b, h*w, 4)
-
         _, target_bboxes, target_scores, target_embeds, fg_mask, target_gt_idx = (
             self.assigner(
-                pred_scores.detach().sigmoid(),
+                pred_probs,
                 (pred_bboxes.detach() * stride_tensor).type(gt_bboxes.dtype),
                 (pred_embeds.detach()).type(gt_embeds.dtype),
                 anchor_points * stride_tensor,
@@ -153,17 +213,22 @@ class v8DetectionLoss:
             )
         )
 
-        target_scores_sum = max(target_scores.sum(), 1)
+        target_scores_sum = target_scores.sum().clamp(min=1)  # stays on device
 
         # Cls loss
         # loss[1] = self.varifocal_loss(pred_scores, target_scores, target_labels) / target_scores_sum  # VFL way
         loss[1] = (
-            self.bce(pred_scores, target_scores.to(dtype)).sum() / target_scores_sum
+            nn.functional.binary_cross_entropy_with_logits(
+                pred_scores, target_scores.to(dtype), reduction="sum"
+            )
+            / target_scores_sum
         )  # BCE
 
         # Bbox loss
-        if fg_mask.sum():
-            target_bboxes /= stride_tensor
+        embed_mask = torch.zeros_like(fg_mask)
+        # (batch, anchor) indices of the foreground, shared by every gather below
+        fg_idx = fg_mask.nonzero(as_tuple=True)
+        if len(fg_idx[0]):
             loss[0], loss[2], iou_scores = self.bbox_loss(
                 pred_distri,
                 pred_bboxes,
@@ -171,25 +236,31 @@ class v8DetectionLoss:
                 target_bboxes,
                 target_scores,
                 target_scores_sum,
+                fg_idx,
+                stride_tensor,
+            )
+            iou_cls_scores = (iou_scores.detach() * target_scores[fg_idx]).sum(-1)
+            embed_mask = self.select_embed_anchors(
+                iou_cls_scores,
+                fg_idx,
+                target_gt_idx[fg_idx],
                 fg_mask,
+                gt_bboxes.shape[1],
+                embed_topk,
             )
 
-        iou_cls_scores = (iou_scores * target_scores).sum(-1)  # (b, w*h)
-        embed_mask = torch.zeros_like(fg_mask).bool()
-        for batch_index in range(target_gt_idx.shape[0]):
-            for instance_id in torch.unique(target_gt_idx[batch_index]):
-                instance_mask = target_gt_idx[batch_index] == instance_id
-                topk_val, topk_idx = torch.topk(
-                    iou_cls_scores[batch_index] * instance_mask, embed_topk
-                )
-                embed_mask[batch_index][topk_idx] = True
-
         # Embedding loss (euclidean distance)
         # embed_weight = iou_cls_scores[embed_mask]
-        kd = kd_loss(pred_embeds[embed_mask], target_embeds[embed_mask])
-        rkd = rkd_loss(target_embeds[embed_mask], pred_embeds[embed_mask])
-        # loss[3] = (kd + rkd) * embed_weight / embed_weight.sum()
-        loss[3] = kd + rkd
+        # gather once for both terms, nonzero already gives the count on the host
+        embed_idx = embed_mask.nonzero(as_tuple=True)
+        if len(embed_idx[0]):
+            # only the selected anchors reach the loss, so l2-normalize after the gather
+            pos_embeds = nn.functional.normalize(pred_embeds[embed_idx], dim=-1)
+            pos_targets = target_embeds[embed_idx]
+            kd = kd_loss(pos_embeds, pos_targets)
+            rkd = rkd_loss(pos_targets, pos_embeds)
+            # loss[3] = (kd + rkd) * embed_weight / embed_weight.sum()
+            loss[3] = kd + rkd
 
         loss[0] *= self.hyp["box"]  # box gain
         loss[1] *= self.hyp["cls"]  # cls gain
@@ -197,7 +268,8 @@ class v8DetectionLoss:
         loss[3] *= self.hyp["embed"]
 
         # loss(box, cls, dfl)
-        return loss.sum(), loss.detach().cpu(), fg_mask
+        # copy explicitly, on CPU .cpu() would alias the reused buffer
+        return loss.sum(), loss.detach().to("cpu", copy=True), fg_mask
 
 
 class BboxLoss(nn.Module):
@@ -207,6 +279,7 @@ class BboxLoss(nn.Module):
         """Initialize the BboxLoss module with regularization maximum and DFL settings."""
         super().__init__()
         self.dfl_loss = DFLoss(reg_max) if reg_max > 1 else None
+        self.register_buffer("_zero", torch.zeros(()), persistent=False)
 
     def forward(
         self,
@@ -216,28 +289,34 @@ class BboxLoss(nn.Module):
         target_bboxes,
         target_scores,
         target_scores_sum,
-        fg_mask,
+        fg_idx,
+        stride_tensor,
     ):
-        """IoU loss."""
-        weight = target_scores.sum(-1)[fg_mask].unsqueeze(-1)
-        iou = bbox_iou(pred_bboxes, target_bboxes, xywh=False, CIoU=True)
-        iou_scores = (1.0 - iou[fg_mask]) * weight
+        """IoU loss, also returns the CIoU of the foreground anchors, (n_fg, 1)."""
+        anchor_idx = fg_idx[1]
+        weight = target_scores[fg_idx].sum(-1, keepdim=True)
+        # target boxes are in pixels, rescale only the foreground ones to grid units
+        target_bboxes = target_bboxes[fg_idx] / stride_tensor[anchor_idx]
+        iou = bbox_iou(pred_bboxes[fg_idx], target_bboxes, xywh=False, CIoU=True)
+        iou_scores = (1.0 - iou) * weight
         loss_iou = iou_scores.sum() / target_scores_sum
 
         # DFL loss
         if self.dfl_loss:
             target_ltrb = bbox2dist(
-                anchor_points, target_bboxes, self.dfl_loss.reg_max - 1
+                anchor_points[anchor_idx],
+                target_bboxes,
+                self.dfl_loss.reg_max - 1,
             )
             loss_dfl = (
                 self.dfl_loss(
-                    pred_dist[fg_mask].view(-1, self.dfl_loss.reg_max),
-                    target_ltrb[fg_mask],
+                    pred_dist[fg_idx].view(-1, self.dfl_loss.reg_max),
+                    target_ltrb,
                 )
                 * weight
             )
             loss_dfl = loss_dfl.sum() / target_scores_sum
         else:
-            loss_dfl = torch.tensor(0.0).to(pred_dist.device)
+            loss_dfl = self._zero
 
         return loss_iou, loss_dfl, iou
@@ -0,0 +1,41 @@
+import types
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("ultralytics")
+
+from loss.torch.detection_loss import v8DetectionLoss  # noqa: E402
+
+
+def make_inputs(counts=(3, 5, 2, 4), bbox_dtype=torch.float32):
+    g = torch.Generator().manual_seed(0)
+    head = types.SimpleNamespace(
+        stride=torch.tensor([8.0, 16.0, 32.0]), nc=1, reg_max=16, embedding_size=32
+    )
+    batch_size = len(counts)
+    feats = [torch.randn(batch_size, 65, s, s, generator=g) for s in (32, 16, 8)]
+    embeds = [torch.randn(batch_size, 32, s, s, generator=g) for s in (32, 16, 8)]
+    n = sum(counts)
+    xy = torch.rand(n, 2, generator=g) * 0.6 + 0.2
+    wh = torch.rand(n, 2, generator=g) * 0.2 + 0.1
+    batch = {
+        "batch_idx": torch.repeat_interleave(
+            torch.arange(batch_size), torch.tensor(counts)
+        ),
+        "cls": torch.zeros(n),
+        "bboxes": torch.cat((xy, wh), 1).to(bbox_dtype),
+        "embedding": torch.randn(n, 32, generator=g),
+    }
+    return head, feats, embeds, batch
+
+
+def test_float64_bboxes():
+    # train_distillation.py builds bboxes from float64 numpy arrays
+    head, feats, embeds, batch = make_inputs()
+    loss_fn = v8DetectionLoss(head, "cpu")
+    _, ref, _ = loss_fn(((None, feats), embeds), batch)
+
+    batch["bboxes"] = batch["bboxes"].double()
+    _, loss_items, _ = loss_fn(((None, feats), embeds), batch)
+    assert torch.allclose(loss_items, ref)